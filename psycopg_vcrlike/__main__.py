@@ -0,0 +1,175 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Maintain psycopg_vcrlike cassettes from the command line.
+
+Run ``python -m psycopg_vcrlike --help`` for the list of commands.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import pathlib
+import sys
+import typing
+
+from psycopg_vcrlike import _cassettes
+
+T = typing.TypeVar('T')
+
+
+def _parallel(
+    f: typing.Callable[[pathlib.Path], T],
+    paths: list[pathlib.Path],
+    jobs: int | None,
+) -> typing.Iterator[tuple[pathlib.Path, T]]:
+    if jobs == 1 or len(paths) <= 1:
+        yield from ((p, f(p)) for p in paths)
+        return
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, len(paths) // (4 * jobs))
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        results = pool.map(f, paths, chunksize=chunksize)
+        yield from zip(paths, results, strict=True)
+
+
+def _format(st: typing.Mapping[str, int]) -> str:
+    return ' '.join(f'{k}={v}' for k, v in st.items())
+
+
+def _stats(args: argparse.Namespace) -> int:
+    total: collections.Counter[str] = collections.Counter()
+    per_cassette = {}
+    for path, st in _parallel(_cassettes.stats, args.cassettes, args.jobs):
+        total.update(st)
+        per_cassette[str(path)] = st
+        if not args.json:
+            print(path, _format(st))  # noqa: T201
+    if args.json:
+        report = {'cassettes': per_cassette, 'total': dict(total)}
+        print(json.dumps(report, indent=2))  # noqa: T201
+    else:
+        print('total', _format(total))  # noqa: T201
+    return 0
+
+
+def _convert(args: argparse.Namespace) -> int:
+    f = functools.partial(
+        _cassettes.convert,
+        to=args.to,
+        responses_dir=args.responses_dir,
+    )
+    for path, message in _parallel(f, args.cassettes, args.jobs):
+        print(path, message)  # noqa: T201
+    return 0
+
+
+def _prune(args: argparse.Namespace) -> int:
+    for path, message in _parallel(
+        _cassettes.prune,
+        args.cassettes,
+        args.jobs,
+    ):
+        print(path, message)  # noqa: T201
+    return 0
+
+
+def _reindex(args: argparse.Namespace) -> int:
+    referrers: dict[str, list[str]] = collections.defaultdict(list)
+    for path, digests in _parallel(
+        _cassettes.digests,
+        args.cassettes,
+        args.jobs,
+    ):
+        for digest in digests:
+            referrers[digest].append(str(path))
+    _cassettes.write_index(args.responses_dir, referrers)
+    stored = set(_cassettes.stored(args.responses_dir))
+    missing = sorted(set(referrers) - stored)
+    unreferenced = sorted(stored - set(referrers))
+    for digest in missing:
+        print('missing', digest)  # noqa: T201
+    for digest in unreferenced:
+        if args.delete_unreferenced:
+            (args.responses_dir / f'{digest}.yml').unlink()
+            print('deleted', digest)  # noqa: T201
+        else:
+            print('unreferenced', digest)  # noqa: T201
+    print(  # noqa: T201
+        f'{len(referrers)} responses referenced, {len(missing)} missing, '
+        f'{len(unreferenced)} unreferenced',
+    )
+    return 1 if missing else 0
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='python -m psycopg_vcrlike',
+        description='Maintain psycopg_vcrlike cassettes.',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        help='number of worker processes (default: one per CPU)',
+    )
+    commands = parser.add_subparsers(required=True, metavar='COMMAND')
+
+    def command(
+        name: str,
+        f: typing.Callable[[argparse.Namespace], int],
+        description: str,
+    ) -> argparse.ArgumentParser:
+        p = commands.add_parser(
+            name,
+            help=description,
+            description=description,
+        )
+        p.set_defaults(func=f)
+        p.add_argument('cassettes', nargs='+', type=pathlib.Path)
+        return p
+
+    p = command('stats', _stats, 'report size and entry statistics')
+    p.add_argument('--json', action='store_true', help='output JSON')
+
+    p = command(
+        'convert',
+        _convert,
+        'move responses to a shared response store or back inline',
+    )
+    p.add_argument('--to', choices=['shared', 'inline'], required=True)
+    p.add_argument('--responses-dir', type=pathlib.Path, required=True)
+
+    command(
+        'prune',
+        _prune,
+        'drop entries not consumed during a replay run '
+        'with --vcr-psycopg-track-usage',
+    )
+
+    p = command(
+        'reindex',
+        _reindex,
+        'rebuild the index of which cassettes refer to each shared response',
+    )
+    p.add_argument('--responses-dir', type=pathlib.Path, required=True)
+    p.add_argument(
+        '--delete-unreferenced',
+        action='store_true',
+        help='delete shared responses no cassette refers to',
+    )
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the command line interface."""
+    args = _parser().parse_args(argv)
+    return typing.cast(int, args.func(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -47,4 +47,9 @@ async def write_file(path: pathlib.Path, mode: 'ModeWrite', data: str) -> None:
         f.write(data)
 
 
-__all__ = ['makedirs', 'read_file', 'unlink', 'write_file']
+async def replace(path: pathlib.Path, target: pathlib.Path) -> None:
+    # not async! makes it easy on cancellation
+    path.replace(target)
+
+
+__all__ = ['makedirs', 'read_file', 'replace', 'unlink', 'write_file']
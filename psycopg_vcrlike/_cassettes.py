@@ -0,0 +1,150 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Operations on whole cassette files, used for maintaining them.
+
+Every operation takes a single cassette and returns something picklable,
+so that many cassettes can be processed in parallel in a process pool.
+"""
+
+import asyncio
+import io
+import os
+import pathlib
+import typing
+
+import ruamel.yaml
+
+from psycopg_vcrlike import _response_store
+
+Recording = list[dict[str, typing.Any]]
+
+INDEX = 'index.yml'
+
+
+def _yaml() -> ruamel.yaml.YAML:
+    return ruamel.yaml.YAML(typ='safe')
+
+
+def load(path: pathlib.Path) -> Recording:
+    with path.open() as f:
+        return list(_yaml().load(f) or [])
+
+
+def dump(path: pathlib.Path, recording: Recording) -> None:
+    with io.StringIO() as sio:
+        yaml = _yaml()
+        # one entry at a time, producing the same output as recording does
+        for entry in recording:
+            yaml.dump([entry], sio)
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_text(sio.getvalue())
+        tmp.replace(path)
+
+
+def usage_path(path: pathlib.Path) -> pathlib.Path:
+    """Return where the entries consumed during replay are listed."""
+    return path.with_suffix('.used')
+
+
+def save_usage(path: pathlib.Path, consumed: typing.Iterable[int]) -> None:
+    """Merge the indices of consumed entries into the usage file."""
+    consumed = set(consumed)
+    usage = usage_path(path)
+    if usage.exists():
+        consumed.update(_yaml().load(usage.read_text()) or [])
+    with usage.open('w') as f:
+        _yaml().dump(sorted(consumed), f)
+
+
+def stats(path: pathlib.Path) -> dict[str, int]:
+    recording = load(path)
+    return {
+        'bytes': path.stat().st_size,
+        'entries': len(recording),
+        'results': sum(
+            e.get('response') is not None or 'response_sha256' in e
+            for e in recording
+        ),
+        'inline_rows': sum(len(e.get('response') or ()) for e in recording),
+        'shared': sum('response_sha256' in e for e in recording),
+    }
+
+
+def convert(path: pathlib.Path, to: str, responses_dir: pathlib.Path) -> str:
+    """Move responses to the shared store (to='shared') or back inline."""
+    recording = load(path)
+    changed = asyncio.run(_convert(recording, to, responses_dir))
+    if changed:
+        dump(path, recording)
+    return f'{changed} entries converted'
+
+
+async def _convert(
+    recording: Recording,
+    to: str,
+    responses_dir: pathlib.Path,
+) -> int:
+    changed = 0
+    for entry in recording:
+        if to == 'shared' and entry.get('response') is not None:
+            response = entry.pop('response')
+            digest = await _response_store.save(responses_dir, response)
+            entry['response_sha256'] = digest
+            changed += 1
+        elif to == 'inline' and 'response_sha256' in entry:
+            digest = entry.pop('response_sha256')
+            response = await _response_store.load(responses_dir, digest)
+            entry['response'] = response
+            changed += 1
+    return changed
+
+
+def prune(path: pathlib.Path) -> str:
+    """Drop the entries that were not consumed during replay."""
+    usage = usage_path(path)
+    if not usage.exists():
+        return 'skipped, no usage recorded'
+    consumed = set(_yaml().load(usage.read_text()) or [])
+    recording = load(path)
+    kept = [e for i, e in enumerate(recording) if i in consumed]
+    if len(kept) < len(recording):
+        dump(path, kept)
+    usage.unlink()
+    return f'{len(recording) - len(kept)} entries pruned'
+
+
+def digests(path: pathlib.Path) -> list[str]:
+    """List the shared responses a cassette refers to."""
+    return [e['response_sha256'] for e in load(path) if 'response_sha256' in e]
+
+
+def write_index(
+    responses_dir: pathlib.Path,
+    referrers: dict[str, list[str]],
+) -> None:
+    """Write which cassettes refer to each of the shared responses."""
+    responses_dir.mkdir(parents=True, exist_ok=True)
+    with (responses_dir / INDEX).open('w') as f:
+        _yaml().dump(dict(sorted(referrers.items())), f)
+
+
+def stored(responses_dir: pathlib.Path) -> list[str]:
+    """List the digests of all responses in the shared store."""
+    return sorted(
+        p.stem for p in responses_dir.glob('*.yml') if p.name != INDEX
+    )
+
+
+__all__ = [
+    'convert',
+    'digests',
+    'dump',
+    'load',
+    'prune',
+    'save_usage',
+    'stats',
+    'stored',
+    'usage_path',
+    'write_index',
+]
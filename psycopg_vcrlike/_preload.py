@@ -0,0 +1,136 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Parsing the cassettes of upcoming tests in background processes.
+
+Cassette paths are predicted after collection the way pytest-recording
+names them by default, so tests overriding vcr_cassette_dir
+or default_cassette_name just don't get theirs preloaded.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import pathlib
+
+import pytest
+from pytest_recording.plugin import get_default_cassette_name
+
+from psycopg_vcrlike import _cassettes
+
+# parsed cassettes take about this many times their file size in memory,
+# measured at 6-8 for cassettes dominated by rows and more for tiny ones
+PARSED_SIZE_RATIO = 8
+
+_preloaded: dict[
+    pathlib.Path,
+    concurrent.futures.Future[_cassettes.Recording],
+] = {}
+
+
+def get(
+    vcr_path: pathlib.Path,
+) -> concurrent.futures.Future[_cassettes.Recording] | None:
+    """Return the cassette being preloaded, if any. Don't modify it."""
+    return _preloaded.get(vcr_path)
+
+
+def _cassette_path(item: pytest.Item) -> pathlib.Path:
+    marker = item.get_closest_marker('default_cassette')
+    if marker is not None:
+        name = marker.args[0]
+    else:
+        name = get_default_cassette_name(
+            getattr(item, 'cls', None),
+            item.name,
+        )
+    return pathlib.Path(
+        item.path.parent,
+        'cassettes',
+        item.path.stem,
+        name + '.psycopg.yml',
+    )
+
+
+class Preloader:
+    """Pytest plugin parsing cassettes a few tests ahead of their use.
+
+    At most `window` tests ahead, and at most `max_bytes` of memory
+    taken by parsed cassettes at once, as estimated from their file sizes.
+    Cassettes larger than that on their own are left alone.
+    """
+
+    def __init__(self, window: int, max_bytes: int) -> None:
+        self._window = window
+        self._max_bytes = max_bytes
+        self._paths: list[pathlib.Path | None] = []  # by position in a run
+        self._positions: dict[str, int] = {}  # by nodeid
+        self._sizes: dict[pathlib.Path, int] = {}  # estimated when parsed
+        self._last_use: dict[pathlib.Path, int] = {}
+        self._bytes = 0
+        self._pool: concurrent.futures.ProcessPoolExecutor | None = None
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_collection_finish(self, session: pytest.Session) -> None:
+        """Plan preloading once the order of tests is final."""
+        if session.config.getoption('record_mode') == 'rewrite':
+            return  # nothing is going to be replayed
+        for i, item in enumerate(session.items):
+            self._positions[item.nodeid] = i
+            path = None
+            if item.get_closest_marker('vcr') is not None:
+                path = _cassette_path(item)
+                if path not in self._sizes:
+                    try:
+                        size = path.stat().st_size * PARSED_SIZE_RATIO
+                        self._sizes[path] = size
+                    except FileNotFoundError:
+                        path = None  # going to be recorded
+                if path is not None and self._sizes[path] > self._max_bytes:
+                    path = None
+            if path is not None:
+                self._last_use[path] = i
+            self._paths.append(path)
+        if self._last_use:
+            workers = min(self._window, os.cpu_count() or 1)
+            # workers start lazily, when tests may already run threads,
+            # so they'd better not be forked from this process
+            methods = multiprocessing.get_all_start_methods()
+            method = 'forkserver' if 'forkserver' in methods else 'spawn'
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context(method),
+            )
+            self._advance(0)
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_setup(self, item: pytest.Item) -> None:
+        """Drop the cassettes no longer needed, preload the next ones."""
+        position = self._positions.get(item.nodeid)
+        if position is not None and self._pool is not None:
+            self._advance(position)
+
+    def pytest_sessionfinish(self) -> None:
+        """Stop preloading."""
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+        _preloaded.clear()
+
+    def _advance(self, position: int) -> None:
+        if self._pool is None:
+            return
+        for path in list(_preloaded):
+            if self._last_use[path] < position:
+                del _preloaded[path]
+                self._bytes -= self._sizes[path]
+        for upcoming in self._paths[position : position + self._window]:
+            if upcoming is None or upcoming in _preloaded:
+                continue
+            if self._bytes + self._sizes[upcoming] > self._max_bytes:
+                break  # retried once the earlier ones get dropped
+            future = self._pool.submit(_cassettes.load, upcoming)
+            _preloaded[upcoming] = future
+            self._bytes += self._sizes[upcoming]
+
+
+__all__ = ['Preloader', 'get']
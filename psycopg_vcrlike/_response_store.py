@@ -0,0 +1,62 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Content-addressed store of responses shared between cassettes.
+
+Each response is stored once as ``<sha256>.yml`` and cassettes refer to it
+by that digest. Loaded responses are kept in memory for the whole session,
+so tests replaying identical responses share one parsed copy.
+Batches of server-side cursors are the exception, read anew when fetched
+and dropped right after, so that paging through them stays bounded.
+"""
+
+import hashlib
+import io
+import os
+import pathlib
+import typing
+
+import ruamel.yaml
+
+from psycopg_vcrlike import _aio_fileutils_builtin as aiofileutils
+
+_Rows = list[typing.Any]
+
+_loaded: dict[str, _Rows] = {}  # digest -> parsed response
+
+
+def path(store: pathlib.Path, digest: str) -> pathlib.Path:
+    return store / f'{digest}.yml'
+
+
+async def save(store: pathlib.Path, rows: _Rows) -> str:
+    with io.StringIO() as sio:
+        ruamel.yaml.YAML(typ='safe').dump(rows, sio)
+        data = sio.getvalue()
+    digest = hashlib.sha256(data.encode()).hexdigest()
+    target = path(store, digest)
+    if not target.exists():
+        await aiofileutils.makedirs(store, exist_ok=True)
+        # same digest means same contents, so concurrent writers can't clash
+        tmp = target.with_suffix(f'.{os.getpid()}.tmp')
+        await aiofileutils.write_file(tmp, 'w', data)
+        await aiofileutils.replace(tmp, target)
+    return digest
+
+
+async def load(
+    store: pathlib.Path,
+    digest: str,
+    *,
+    keep: bool = True,
+) -> _Rows:
+    rows = _loaded.get(digest)
+    if rows is None:
+        data = await aiofileutils.read_file(path(store, digest), 'r')
+        rows = ruamel.yaml.YAML(typ='safe').load(data)
+        if keep:
+            _loaded[digest] = rows
+    return rows
+
+
+__all__ = ['load', 'path', 'save']
@@ -0,0 +1,483 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Local server replaying a cassette over the PostgreSQL wire protocol.
+
+Speaks just enough of the frontend/backend protocol v3 to replay:
+no authentication or TLS, simple and extended queries, text results only.
+Queries are matched the way psycopg puts them on the wire,
+so other processes connecting to the DSN with psycopg can replay
+a cassette recorded in-process, many of them at once.
+"""
+
+import asyncio
+import contextlib
+import json
+import pathlib
+import struct
+import threading
+import typing
+
+from psycopg._queries import PostgresQuery
+from psycopg.adapt import PyFormat, Transformer
+
+from psycopg_vcrlike import _cassettes, _preload
+from psycopg_vcrlike._vcr import _Entry, _ReplayedPGresult, _resolve_responses
+
+# query and parameters, as sent by a client
+_Key = tuple[bytes, tuple[bytes | None, ...]]
+# row description (None for no data), the rest of the response and its tag
+_Result = tuple[bytes | None, bytes, str]
+
+_PROTOCOL_V3 = 196608
+_SSL_REQUEST = 80877103
+_GSSENC_REQUEST = 80877104
+
+_PARAMETERS = {
+    'server_version': '16.0',
+    'server_encoding': 'UTF8',
+    'client_encoding': 'UTF8',
+    'DateStyle': 'ISO, MDY',
+    'IntervalStyle': 'postgres',
+    'TimeZone': 'UTC',
+    'integer_datetimes': 'on',
+    'standard_conforming_strings': 'on',
+}
+
+# commands answered even if they aren't in the cassette, like psycopg's
+# transaction control and prepared statements maintenance
+# or pools resetting connections, which never go through recording cursors
+_COMMAND_TAGS = {
+    'BEGIN': 'BEGIN',
+    'START': 'START TRANSACTION',
+    'COMMIT': 'COMMIT',
+    'END': 'COMMIT',
+    'ROLLBACK': 'ROLLBACK',
+    'ABORT': 'ROLLBACK',
+    'SAVEPOINT': 'SAVEPOINT',
+    'RELEASE': 'RELEASE',
+    'SET': 'SET',
+    'RESET': 'RESET',
+    'DEALLOCATE': 'DEALLOCATE',
+    'DISCARD': 'DISCARD',
+}
+
+
+class _Error(Exception):
+    def __init__(self, message: str, sqlstate: str) -> None:
+        super().__init__(message)
+        self.sqlstate = sqlstate
+
+    def response(self) -> bytes:
+        fields = {
+            'S': 'ERROR',
+            'V': 'ERROR',
+            'C': self.sqlstate,
+            'M': str(self),
+        }
+        return _message(
+            b'E',
+            b''.join(f'{k}{v}\0'.encode() for k, v in fields.items()) + b'\0',
+        )
+
+
+def _message(kind: bytes, payload: bytes = b'') -> bytes:
+    return kind + struct.pack('!i', len(payload) + 4) + payload
+
+
+def _cstring(data: bytes, pos: int) -> tuple[bytes, int]:
+    end = data.index(b'\0', pos)
+    return data[pos:end], end + 1
+
+
+def _unsupported(_payload: bytes) -> None:
+    msg = 'unsupported message'
+    raise _Error(msg, '08P01')
+
+
+class _Cassette:
+    """Entries of a cassette, indexed by how they are sent over the wire.
+
+    Shared between all the connections, responses are encoded once.
+    """
+
+    def __init__(self, recording: list[_Entry]) -> None:
+        self._recording = recording
+        self._tx = Transformer()
+        self._index: dict[_Key, list[int]] = {}
+        for i, entry in enumerate(recording):
+            request = entry['request']
+            if 'query' not in request or 'cursor' in request:
+                continue  # server-side cursors only replay in-process
+            pq = PostgresQuery(self._tx)
+            pq.convert(request['query'], request['params'])
+            params = tuple(
+                bytes(p) if p is not None else None for p in pq.params or ()
+            )
+            self._index.setdefault((pq.query, params), []).append(i)
+        self._results: dict[int, _Result] = {}
+        self.consumed: set[int] = set()
+
+    def match(self, key: _Key, used: dict[_Key, int]) -> _Result | None:
+        """Return the first matching result not used by this connection."""
+        positions = self._index.get(key, ())
+        n = used.get(key, 0)
+        if n >= len(positions):
+            return None
+        used[key] = n + 1
+        self.consumed.add(positions[n])
+        return self._result(positions[n])
+
+    def _result(self, position: int) -> _Result:
+        result = self._results.get(position)
+        if result is None:
+            result = self._results[position] = self._encode(position)
+        return result
+
+    def _encode(self, position: int) -> _Result:
+        entry = self._recording[position]
+        res = _ReplayedPGresult(entry)
+        rows = entry.get('response')
+        row_description = None
+        if res.nfields:
+            row_description = _message(
+                b'T',
+                struct.pack('!h', res.nfields)
+                + b''.join(
+                    res.fname(i)
+                    + b'\0'
+                    + struct.pack(
+                        '!ihihih',
+                        0,  # table
+                        0,  # column
+                        res.ftype(i),
+                        res.fsize(i),
+                        res.fmod(i),
+                        0,  # text format
+                    )
+                    for i in range(res.nfields)
+                ),
+            )
+        data_rows = b''.join(
+            _message(b'D', struct.pack('!h', len(row)) + self._values(row))
+            for row in rows or ()
+        )
+        if res.command_status is not None:
+            tag = res.command_status.decode()
+        else:  # recorded without metadata
+            tag = f'SELECT {res.ntuples}' if rows is not None else 'OK'
+        complete = _message(b'C', tag.encode() + b'\0')
+        return row_description, data_rows + complete, tag
+
+    def _values(self, row: typing.Iterable[typing.Any]) -> bytes:
+        values = []
+        for value in row:
+            if value is None:
+                values.append(struct.pack('!i', -1))
+                continue
+            if isinstance(value, bytes):
+                text = b'\\x' + value.hex().encode()
+            elif isinstance(value, dict):
+                text = json.dumps(value).encode()
+            else:
+                dumper = self._tx.get_dumper(value, PyFormat.TEXT)
+                text = bytes(dumper.dump(value))
+            values.append(struct.pack('!i', len(text)) + text)
+        return b''.join(values)
+
+
+class _Session:
+    """A single client connection."""
+
+    def __init__(
+        self,
+        cassette: _Cassette,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        self._cassette = cassette
+        self._reader = reader
+        self._writer = writer
+        self._used: dict[_Key, int] = {}
+        self._statements: dict[bytes, tuple[bytes, int]] = {}
+        self._portals: dict[bytes, tuple[list[str], _Result]] = {}
+        self._status = b'I'
+        self._skipping = False  # until Sync, after an extended query error
+
+    async def serve(self) -> None:
+        try:
+            if await self._startup():
+                await self._loop()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writer.close()
+
+    async def _startup(self) -> bool:
+        while True:
+            (length,) = struct.unpack('!i', await self._reader.readexactly(4))
+            payload = await self._reader.readexactly(length - 4)
+            (code,) = struct.unpack_from('!i', payload)
+            if code not in {_SSL_REQUEST, _GSSENC_REQUEST}:
+                break
+            self._writer.write(b'N')  # no encryption, carry on in plain
+        if code != _PROTOCOL_V3:
+            return False  # cancel request or an unsupported protocol
+        self._writer.write(
+            _message(b'R', struct.pack('!i', 0))  # AuthenticationOk
+            + b''.join(
+                _message(b'S', k.encode() + b'\0' + v.encode() + b'\0')
+                for k, v in _PARAMETERS.items()
+            )
+            + _message(b'K', struct.pack('!ii', id(self) & 0x7FFFFFFF, 0))
+            + self._ready(),
+        )
+        await self._writer.drain()
+        return True
+
+    async def _loop(self) -> None:
+        handlers = {
+            b'Q': self._query,
+            b'P': self._parse,
+            b'B': self._bind,
+            b'D': self._describe,
+            b'E': self._execute,
+            b'C': self._close,
+            b'S': self._sync,
+            b'H': self._flush,
+        }
+        while True:
+            kind = await self._reader.readexactly(1)
+            (length,) = struct.unpack('!i', await self._reader.readexactly(4))
+            payload = await self._reader.readexactly(length - 4)
+            if kind == b'X':  # Terminate
+                return
+            if self._skipping and kind != b'S':
+                continue
+            try:
+                handlers.get(kind, _unsupported)(payload)
+            except _Error as e:
+                self._writer.write(e.response())
+                if self._status == b'T':
+                    self._status = b'E'
+                if kind == b'Q':
+                    self._writer.write(self._ready())
+                else:
+                    self._skipping = True
+            if kind in {b'Q', b'S', b'H'}:
+                await self._writer.drain()
+
+    def _ready(self) -> bytes:
+        return _message(b'Z', self._status)
+
+    def _answer(
+        self,
+        query: bytes,
+        params: tuple[bytes | None, ...],
+    ) -> tuple[list[str], _Result]:
+        words = query.decode().upper().replace(';', ' ').split()
+        if not words:
+            return words, (None, _message(b'I'), '')  # EmptyQueryResponse
+        command = words[0]
+        if self._status == b'E' and command not in {
+            'ROLLBACK',
+            'ABORT',
+            'COMMIT',
+            'END',
+        }:
+            msg = (
+                'current transaction is aborted, '
+                'commands ignored until end of transaction block'
+            )
+            raise _Error(msg, '25P02')
+        result = self._cassette.match((query, params), self._used)
+        if result is None:
+            tag = _COMMAND_TAGS.get(command)
+            if tag is None:
+                msg = 'no matching response in recording'
+                raise _Error(msg, 'XX000')
+            if tag == 'COMMIT' and self._status == b'E':
+                tag = 'ROLLBACK'
+            elif tag == 'DEALLOCATE' and words[-1] == 'ALL':
+                tag = 'DEALLOCATE ALL'
+            elif tag == 'DISCARD' and len(words) > 1:
+                what = words[1].replace('TEMPORARY', 'TEMP')
+                tag = f'DISCARD {what}'
+            result = None, _message(b'C', tag.encode() + b'\0'), tag
+        return words, result
+
+    def _transition(self, words: list[str], tag: str) -> None:
+        if tag in {'BEGIN', 'START TRANSACTION'}:
+            if self._status == b'I':
+                self._status = b'T'
+        elif tag == 'ROLLBACK' and 'TO' in words[1:3]:  # to a savepoint
+            if self._status == b'E':
+                self._status = b'T'
+        elif tag in {'COMMIT', 'ROLLBACK'}:
+            self._status = b'I'
+
+    def _query(self, payload: bytes) -> None:
+        words, (row_description, rest, tag) = self._answer(payload[:-1], ())
+        if row_description is not None:
+            self._writer.write(row_description)
+        self._writer.write(rest)
+        self._transition(words, tag)
+        self._writer.write(self._ready())
+
+    def _parse(self, payload: bytes) -> None:
+        name, pos = _cstring(payload, 0)
+        query, pos = _cstring(payload, pos)
+        (nparams,) = struct.unpack_from('!h', payload, pos)
+        self._statements[name] = query, nparams
+        self._writer.write(_message(b'1'))  # ParseComplete
+
+    def _bind(self, payload: bytes) -> None:
+        portal, pos = _cstring(payload, 0)
+        statement, pos = _cstring(payload, pos)
+        if statement not in self._statements:
+            msg = f'prepared statement {statement.decode()!r} does not exist'
+            raise _Error(msg, '26000')
+        (nformats,) = struct.unpack_from('!h', payload, pos)
+        pos += 2 + 2 * nformats
+        (nparams,) = struct.unpack_from('!h', payload, pos)
+        pos += 2
+        params: list[bytes | None] = []
+        for _ in range(nparams):
+            (length,) = struct.unpack_from('!i', payload, pos)
+            pos += 4
+            if length < 0:
+                params.append(None)
+            else:
+                params.append(payload[pos : pos + length])
+                pos += length
+        (nresults,) = struct.unpack_from('!h', payload, pos)
+        if any(struct.unpack_from(f'!{nresults}h', payload, pos + 2)):
+            msg = 'only text results can be replayed over the wire'
+            raise _Error(msg, '0A000')
+        query, _ = self._statements[statement]
+        self._portals[portal] = self._answer(query, tuple(params))
+        self._writer.write(_message(b'2'))  # BindComplete
+
+    def _describe(self, payload: bytes) -> None:
+        name, _ = _cstring(payload, 1)
+        if payload[:1] == b'S':
+            if name not in self._statements:
+                msg = f'prepared statement {name.decode()!r} does not exist'
+                raise _Error(msg, '26000')
+            _, nparams = self._statements[name]
+            # parameter types are left for the client to infer
+            self._writer.write(
+                _message(b't', struct.pack(f'!h{nparams}i', nparams)),
+            )
+            self._writer.write(_message(b'n'))  # NoData
+            return
+        if name not in self._portals:
+            msg = f'portal {name.decode()!r} does not exist'
+            raise _Error(msg, '34000')
+        _, (row_description, _, _) = self._portals[name]
+        self._writer.write(row_description or _message(b'n'))
+
+    def _execute(self, payload: bytes) -> None:
+        name, _ = _cstring(payload, 0)
+        if name not in self._portals:
+            msg = f'portal {name.decode()!r} does not exist'
+            raise _Error(msg, '34000')
+        words, (_, rest, tag) = self._portals[name]
+        self._writer.write(rest)
+        self._transition(words, tag)
+
+    def _close(self, payload: bytes) -> None:
+        name, _ = _cstring(payload, 1)
+        if payload[:1] == b'S':
+            self._statements.pop(name, None)
+        else:
+            self._portals.pop(name, None)
+        self._writer.write(_message(b'3'))  # CloseComplete
+
+    def _flush(self, _payload: bytes) -> None:
+        pass  # writes are drained after every Flush anyway
+
+    def _sync(self, _payload: bytes) -> None:
+        self._skipping = False
+        self._writer.write(self._ready())
+
+
+async def _start(
+    recording: list[_Entry],
+    responses_dir: pathlib.Path | None,
+) -> tuple[asyncio.Server, _Cassette, set[asyncio.StreamWriter]]:
+    await _resolve_responses(recording, responses_dir)
+    cassette = _Cassette(recording)
+    writers: set[asyncio.StreamWriter] = set()
+
+    async def session(
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        writers.add(writer)
+        try:
+            await _Session(cassette, reader, writer).serve()
+        finally:
+            writers.discard(writer)
+
+    server = await asyncio.start_server(session, '127.0.0.1', 0)
+    return server, cassette, writers
+
+
+async def _stop(
+    server: asyncio.Server,
+    writers: set[asyncio.StreamWriter],
+) -> None:
+    server.close()
+    # hang up on the clients still connected and let their sessions end
+    sessions = asyncio.all_tasks() - {asyncio.current_task()}
+    for writer in list(writers):
+        writer.close()
+    await asyncio.gather(*sessions, return_exceptions=True)
+
+
+@contextlib.contextmanager
+def serve_cassette(
+    vcr_path: pathlib.Path,
+    *,
+    responses_dir: pathlib.Path | None = None,
+    consumed: set[int] | None = None,
+) -> typing.Iterator[str]:
+    """Replay a cassette to whoever connects, yielding the DSN to use.
+
+    Positions of the entries used are added to `consumed` on stopping.
+    """
+    preloaded = _preload.get(vcr_path)
+    recording = typing.cast(
+        list[_Entry],
+        list(preloaded.result()) if preloaded else _cassettes.load(vcr_path),
+    )
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(
+        target=loop.run_forever,
+        name=f'psycopg_vcrlike server for {vcr_path.name}',
+        daemon=True,
+    )
+    thread.start()
+    try:
+        server, cassette, writers = asyncio.run_coroutine_threadsafe(
+            _start(recording, responses_dir),
+            loop,
+        ).result()
+        try:
+            host, port = server.sockets[0].getsockname()[:2]
+            yield f'postgresql://vcr@{host}:{port}/vcr?sslmode=disable'
+        finally:
+            asyncio.run_coroutine_threadsafe(
+                _stop(server, writers),
+                loop,
+            ).result()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    if consumed is not None:
+        consumed.update(cassette.consumed)
+
+
+__all__ = ['serve_cassette']
@@ -0,0 +1,842 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Recording cursors and replaying stubs substituted into psycopg."""
+
+import asyncio
+import contextlib
+import io
+import itertools
+import pathlib
+import types
+import typing
+
+import psycopg
+import psycopg_pool
+import ruamel.yaml
+from psycopg import AsyncConnection, AsyncCursor, AsyncServerCursor
+from psycopg.abc import Params, Query
+from psycopg.pq import ExecStatus
+from psycopg.rows import AsyncRowFactory, Row, RowMaker, no_result, tuple_row
+
+from psycopg_vcrlike import _aio_fileutils_builtin as aiofileutils
+from psycopg_vcrlike import _cassettes, _preload, _response_store
+
+CursorRow = typing.TypeVar('CursorRow')
+
+
+class _Request(typing.TypedDict):
+    query: Query
+    params: Params | None
+    prepare: bool | None
+    binary: bool | None
+    # name of the server-side cursor declared, absent for regular cursors
+    cursor: typing.NotRequired[str]
+
+
+class _FetchRequest(typing.TypedDict):
+    cursor: str
+    fetch: int | None  # number of rows fetched, None for all of them
+
+
+_Response = list[tuple[typing.Any, ...]]
+
+
+class _Column(typing.TypedDict):
+    name: str
+    ftype: int
+    fmod: int
+    fsize: int
+
+
+class _Metadata(typing.TypedDict):
+    description: list[_Column] | None
+    rowcount: int
+    statusmessage: str | None
+
+
+class _Entry(typing.TypedDict):
+    request: _Request | _FetchRequest
+    # replaced with response_sha256 when using a shared response store,
+    # always present once loaded
+    response: typing.NotRequired[_Response | None]
+    response_sha256: typing.NotRequired[str]
+    # absent in cassettes recorded before result metadata was captured
+    description: typing.NotRequired[list[_Column] | None]
+    rowcount: typing.NotRequired[int]
+    statusmessage: typing.NotRequired[str | None]
+
+
+async def _record(
+    vcr_path: pathlib.Path,
+    request: _Request | _FetchRequest,
+    response: _Response | None,
+    metadata: _Metadata,
+    responses_dir: pathlib.Path | None = None,
+) -> None:
+    entry: _Entry = {
+        'request': request,
+        'description': metadata['description'],
+        'rowcount': metadata['rowcount'],
+        'statusmessage': metadata['statusmessage'],
+    }
+    if responses_dir is not None and response is not None:
+        digest = await _response_store.save(responses_dir, response)
+        entry['response_sha256'] = digest
+    else:
+        entry['response'] = response
+    with io.StringIO() as sio:
+        yaml = ruamel.yaml.YAML(typ='safe')
+        yaml.dump([entry], sio)
+
+        await aiofileutils.makedirs(vcr_path.parent, exist_ok=True)
+        await aiofileutils.write_file(
+            vcr_path.with_suffix('.tmp'),
+            'a',
+            sio.getvalue(),
+        )
+
+
+class _LimitedAsyncCursor:
+    async def executemany(
+        self,
+        query: Query,
+        params_seq: typing.Iterable[Params],
+        *,
+        returning: bool = False,
+    ) -> None:
+        raise NotImplementedError
+
+    async def stream(  # noqa: PLR6301
+        self,
+        query: Query,  # noqa: ARG002
+        params: Params | None = None,  # noqa: ARG002
+        *,
+        binary: bool | None = None,  # noqa: ARG002
+    ) -> typing.AsyncIterator[Row]:
+        raise NotImplementedError
+        yield
+
+    async def fetchmany(self, size: int = 0) -> list[Row]:
+        raise NotImplementedError
+
+    async def __aiter__(self) -> typing.AsyncIterator[Row]:
+        raise NotImplementedError
+        yield
+
+
+def _current_result(
+    cursor: AsyncCursor[typing.Any],
+) -> tuple[_Response | None, _Metadata]:
+    res = cursor.pgresult
+    results: _Response | None = None
+    description: list[_Column] | None = None
+    if res is not None and res.status == ExecStatus.TUPLES_OK:
+        # load plain tuples regardless of the row factory in use,
+        # leaving the cursor position untouched
+        tx = cursor._tx  # noqa: SLF001
+        results = tx.load_rows(0, res.ntuples, tuple)
+    if res is not None and cursor.description is not None:
+        description = [
+            {
+                'name': column.name,
+                'ftype': res.ftype(i),
+                'fmod': res.fmod(i),
+                'fsize': res.fsize(i),
+            }
+            for i, column in enumerate(cursor.description)
+        ]
+    metadata: _Metadata = {
+        'description': description,
+        'rowcount': cursor.rowcount,
+        'statusmessage': cursor.statusmessage,
+    }
+    return results, metadata
+
+
+def _recording_async_cursor(
+    vcr_path: pathlib.Path,
+    responses_dir: pathlib.Path | None = None,
+) -> type[AsyncCursor[typing.Any]]:
+    class RecordingAsyncCursor(AsyncCursor[typing.Any], _LimitedAsyncCursor):
+        """Recording version of AsyncCursor."""
+
+        async def execute(
+            self: typing.Self,
+            query: Query,
+            params: Params | None = None,
+            *,
+            prepare: bool | None = None,
+            binary: bool | None = None,
+        ) -> typing.Self:
+            """Execute a query or command to the database (recording)."""
+            r = await super().execute(
+                query,
+                params,
+                prepare=prepare,
+                binary=binary,
+            )
+            results, metadata = _current_result(self)
+            request: _Request = {
+                'query': query,
+                'params': params,
+                'prepare': prepare,
+                'binary': binary,
+            }
+            await _record(
+                vcr_path,
+                request,
+                results,
+                metadata,
+                responses_dir,
+            )
+            return r
+
+    return RecordingAsyncCursor
+
+
+def _recording_async_server_cursor(
+    vcr_path: pathlib.Path,
+    responses_dir: pathlib.Path | None = None,
+) -> type[AsyncServerCursor[typing.Any]]:
+    class RecordingAsyncServerCursor(AsyncServerCursor[typing.Any]):
+        """Recording version of AsyncServerCursor.
+
+        Records declaring the cursor and then every batch fetched from it.
+        """
+
+        async def execute(
+            self: typing.Self,
+            query: Query,
+            params: Params | None = None,
+            *,
+            binary: bool | None = None,
+            **kwargs: typing.Any,  # noqa: ANN401
+        ) -> typing.Self:
+            """Declare a server-side cursor (recording)."""
+            r = await super().execute(query, params, binary=binary, **kwargs)
+            _, metadata = _current_result(self)
+            request: _Request = {
+                'query': query,
+                'params': params,
+                'prepare': None,
+                'binary': binary,
+                'cursor': self.name,
+            }
+            await _record(vcr_path, request, None, metadata, responses_dir)
+            return r
+
+        async def _record_fetch(self, size: int | None) -> None:
+            results, metadata = _current_result(self)
+            request: _FetchRequest = {'cursor': self.name, 'fetch': size}
+            await _record(vcr_path, request, results, metadata, responses_dir)
+
+        async def fetchone(self) -> typing.Any:  # noqa: ANN401
+            """Fetch the next row (recording)."""
+            r = await super().fetchone()
+            await self._record_fetch(1)
+            return r
+
+        async def fetchmany(self, size: int = 0) -> list[typing.Any]:
+            """Fetch the next `size` rows (recording)."""
+            size = size or self.arraysize
+            r = await super().fetchmany(size)
+            await self._record_fetch(size)
+            return r
+
+        async def fetchall(self) -> list[typing.Any]:
+            """Fetch all the remaining rows (recording)."""
+            r = await super().fetchall()
+            await self._record_fetch(None)
+            return r
+
+        async def __aiter__(self) -> typing.AsyncIterator[typing.Any]:
+            while True:
+                recs = await self.fetchmany(self.itersize)
+                for rec in recs:
+                    yield rec
+                if len(recs) < self.itersize:
+                    break
+
+    return RecordingAsyncServerCursor
+
+
+class _ReplayedPGresult:
+    """Just enough of psycopg.pq.PGresult for row factories and Column."""
+
+    def __init__(self, entry: _Entry) -> None:
+        rows = entry.get('response')
+        columns = entry.get('description')
+        # recorded without metadata, column names are made up
+        self.guessed_columns = False
+        if columns is None and rows:
+            self.guessed_columns = True
+            columns = [
+                {
+                    'name': f'column_{i + 1}',
+                    'ftype': 0,
+                    'fmod': -1,
+                    'fsize': -1,
+                }
+                for i in range(len(rows[0]))
+            ]
+        self._columns = columns or []
+        self.nfields = len(self._columns)
+        self.ntuples = len(rows) if rows is not None else 0
+        self.status = (
+            ExecStatus.TUPLES_OK if rows is not None else ExecStatus.COMMAND_OK
+        )
+        statusmessage = entry.get('statusmessage')
+        self.command_status = (
+            statusmessage.encode() if statusmessage is not None else None
+        )
+        self.command_tuples = entry.get(
+            'rowcount',
+            self.ntuples if rows is not None else -1,
+        )
+
+    def fname(self, index: int) -> bytes:
+        return self._columns[index]['name'].encode()
+
+    def ftype(self, index: int) -> int:
+        return self._columns[index]['ftype']
+
+    def fmod(self, index: int) -> int:
+        return self._columns[index]['fmod']
+
+    def fsize(self, index: int) -> int:
+        return self._columns[index]['fsize']
+
+
+async def _resolved(
+    entry: _Entry,
+    responses_dir: pathlib.Path | None,
+    *,
+    keep: bool = True,
+) -> _Entry:
+    if 'response_sha256' not in entry:
+        return entry
+    if responses_dir is None:
+        msg = (
+            'cassette refers to shared responses, '
+            'but vcr_psycopg_responses_dir is not set'
+        )
+        raise RuntimeError(msg)
+    # replaced, not modified, as preloaded entries are shared
+    resolved = entry.copy()
+    digest = resolved.pop('response_sha256')
+    resolved['response'] = await _response_store.load(
+        responses_dir,
+        digest,
+        keep=keep,
+    )
+    return resolved
+
+
+async def _resolve_responses(
+    recording: list[_Entry],
+    responses_dir: pathlib.Path | None,
+) -> None:
+    for i, entry in enumerate(recording):
+        if 'fetch' in entry['request']:
+            continue  # server-side cursor batches are loaded once fetched
+        recording[i] = await _resolved(entry, responses_dir)
+
+
+def _replaying_stub_classes(  # noqa: C901
+    vcr_path: pathlib.Path,
+    responses_dir: pathlib.Path | None = None,
+    consumed: set[int] | None = None,
+) -> tuple[type, type, type, type]:
+    class ReplayingStubAsyncCursor(_LimitedAsyncCursor):
+        """Replaying stub of AsyncCursor."""
+
+        _encoding = 'utf-8'
+
+        def __init__(
+            self,
+            connection: typing.Any = None,  # noqa: ANN401
+            *,
+            row_factory: AsyncRowFactory[typing.Any] | None = None,
+        ) -> None:
+            self._conn = connection
+            self._row_factory: AsyncRowFactory[typing.Any] = (
+                getattr(connection, 'row_factory', tuple_row)
+                if row_factory is None
+                else row_factory
+            )
+            self.pgresult: _ReplayedPGresult | None = None
+            self._rows: _Response = []
+            self._pos = 0
+            self._make_row: RowMaker[typing.Any] = no_result
+
+        @property
+        def connection(self) -> typing.Any:  # noqa: ANN401
+            return self._conn
+
+        @property
+        def adapters(self) -> psycopg.adapt.AdaptersMap:
+            return psycopg.adapters
+
+        @property
+        def row_factory(self) -> AsyncRowFactory[typing.Any]:
+            return self._row_factory
+
+        @row_factory.setter
+        def row_factory(self, factory: AsyncRowFactory[typing.Any]) -> None:
+            self._row_factory = factory
+            if self.pgresult is not None:
+                self._make_row = self._row_maker()
+
+        @property
+        def description(self) -> list[psycopg.Column] | None:
+            res = self.pgresult
+            if res is None or not res.nfields:
+                return None
+            return [
+                psycopg.Column(self, i)  # type: ignore[arg-type]
+                for i in range(res.nfields)
+            ]
+
+        @property
+        def rowcount(self) -> int:
+            return self.pgresult.command_tuples if self.pgresult else -1
+
+        @property
+        def rownumber(self) -> int | None:
+            res = self.pgresult
+            tuples = res is not None and res.status == ExecStatus.TUPLES_OK
+            return self._pos if tuples else None
+
+        @property
+        def statusmessage(self) -> str | None:
+            msg = self.pgresult.command_status if self.pgresult else None
+            return msg.decode() if msg else None
+
+        async def _load_recording(self) -> None:
+            if not hasattr(self, '_recording'):
+                preloaded = _preload.get(vcr_path)
+                if preloaded is not None:
+                    # shared with other cursors: copy the list of entries
+                    # and don't let cancelling this one cancel the future
+                    recording = await asyncio.shield(
+                        asyncio.wrap_future(preloaded),
+                    )
+                    self._recording: list[_Entry] = typing.cast(
+                        list[_Entry],
+                        list(recording),
+                    )
+                else:
+                    text = await aiofileutils.read_file(vcr_path, 'r')
+                    yaml = ruamel.yaml.YAML(typ='safe')
+                    self._recording = list(yaml.load(text))
+                # positions in the cassette, kept in step with _recording
+                self._positions = list(range(len(self._recording)))
+                await _resolve_responses(self._recording, responses_dir)
+
+        async def execute(
+            self: typing.Self,
+            query: Query,
+            params: Params | None = None,
+            *,
+            prepare: bool | None = None,
+            binary: bool | None = None,
+        ) -> typing.Self:
+            try:
+                await self._load_recording()
+            except (GeneratorExit, asyncio.CancelledError):
+                return self
+
+            request = {
+                'query': query,
+                'params': list(params) if params is not None else None,
+                'prepare': prepare,
+                'binary': binary,
+            }
+            self._set_result(self._match(request))
+            return self
+
+        def _match(self, request: dict[str, typing.Any]) -> _Entry:
+            for i, r in enumerate(self._recording):
+                if request == r['request']:
+                    return self._take(i)
+            msg = 'no matching response in recording'
+            raise RuntimeError(msg)
+
+        def _take(self, i: int) -> _Entry:
+            # position in the cassette of the entry taken last
+            self._position = self._positions.pop(i)
+            if consumed is not None:
+                consumed.add(self._position)
+            return self._recording.pop(i)
+
+        def _set_result(self, entry: _Entry) -> None:
+            self.pgresult = _ReplayedPGresult(entry)
+            self._rows = entry.get('response') or []
+            self._pos = 0
+            # build the row maker once per result, like psycopg does
+            self._make_row = self._row_maker()
+
+        def _row_maker(self) -> RowMaker[typing.Any]:
+            res = self.pgresult
+            guessed = res is not None and res.guessed_columns
+            factory: typing.Any = self._row_factory
+            if guessed and factory is not tuple_row:
+                msg = (
+                    'cassette entry recorded without column names, '
+                    're-record it to use row factories other than tuple_row'
+                )
+                raise RuntimeError(msg)
+            return self._row_factory(self)  # type: ignore[arg-type]
+
+        def _assert_response(self) -> None:
+            if not hasattr(self, '_recording'):
+                msg = 'no loaded recording, execute a cached response'
+                raise RuntimeError(msg)
+            if self.pgresult is None:
+                msg = 'no loaded response, execute a cached response'
+                raise RuntimeError(msg)
+
+        async def fetchall(self) -> list[typing.Any]:
+            self._assert_response()
+            pos, self._pos = self._pos, len(self._rows)
+            rows = (
+                itertools.islice(self._rows, pos, None) if pos else self._rows
+            )
+            return list(map(self._make_row, rows))
+
+        async def fetchone(self) -> typing.Any:  # noqa: ANN401
+            self._assert_response()
+            if self._pos < len(self._rows):
+                row = self._rows[self._pos]
+                self._pos += 1
+                return self._make_row(row)
+            return None
+
+        async def close(self) -> None:
+            pass
+
+        async def __aenter__(self: typing.Self) -> typing.Self:
+            return self
+
+        async def __aexit__(
+            self: typing.Self,
+            exc_type: type[BaseException] | None,
+            exc_val: BaseException | None,
+            exc_tb: types.TracebackType | None,
+        ) -> bool | None:
+            return None
+
+    class ReplayingStubAsyncServerCursor(ReplayingStubAsyncCursor):
+        """Replaying stub of AsyncServerCursor.
+
+        Replays the rows batch by batch, the way they were fetched,
+        only building the rows of the batches actually asked for.
+        Batches in a shared response store are also only read when fetched.
+        """
+
+        arraysize = 1
+        itersize = 100
+
+        def __init__(  # noqa: PLR0913
+            self,
+            connection: typing.Any,  # noqa: ANN401
+            name: str,
+            *,
+            row_factory: AsyncRowFactory[typing.Any] | None = None,
+            scrollable: bool | None = None,  # noqa: ARG002
+            withhold: bool = False,  # noqa: ARG002
+        ) -> None:
+            super().__init__(connection, row_factory=row_factory)
+            self._name = name
+
+        @property
+        def name(self) -> str:
+            return self._name
+
+        async def execute(
+            self: typing.Self,
+            query: Query,
+            params: Params | None = None,
+            *,
+            binary: bool | None = None,
+            **kwargs: typing.Any,  # noqa: ANN401, ARG002
+        ) -> typing.Self:
+            try:
+                await self._load_recording()
+            except (GeneratorExit, asyncio.CancelledError):
+                return self
+
+            request = {
+                'query': query,
+                'params': list(params) if params is not None else None,
+                'prepare': None,
+                'binary': binary,
+                'cursor': self._name,
+            }
+            self._set_result(self._match(request))
+            self._declared = self._position
+            return self
+
+        def _match_batch(self, size: int | None) -> _Entry:
+            # only the batches between this declaration and the next one
+            # of the same name, as names get reused
+            request = {'cursor': self._name, 'fetch': size}
+            for i, r in enumerate(self._recording):
+                if self._positions[i] < self._declared:
+                    continue
+                if request == r['request']:
+                    return self._take(i)
+                declaration = 'query' in r['request']
+                if declaration and r['request'].get('cursor') == self._name:
+                    break  # declared again
+            msg = 'no matching response in recording'
+            raise RuntimeError(msg)
+
+        async def _fetch(self, size: int | None) -> list[typing.Any]:
+            self._assert_response()
+            # only one batch at a time is kept in memory
+            entry = await _resolved(
+                self._match_batch(size),
+                responses_dir,
+                keep=False,
+            )
+            self.pgresult = _ReplayedPGresult(entry)
+            self._rows = entry.get('response') or []
+            self._pos += len(self._rows)
+            # the row maker built on declaring is reused for every batch
+            return list(map(self._make_row, self._rows))
+
+        async def fetchone(self) -> typing.Any:  # noqa: ANN401
+            rows = await self._fetch(1)
+            return rows[0] if rows else None
+
+        async def fetchmany(self, size: int = 0) -> list[typing.Any]:
+            return await self._fetch(size or self.arraysize)
+
+        async def fetchall(self) -> list[typing.Any]:
+            return await self._fetch(None)
+
+        async def __aiter__(self) -> typing.AsyncIterator[typing.Any]:
+            while True:
+                recs = await self._fetch(self.itersize)
+                for rec in recs:
+                    yield rec
+                if len(recs) < self.itersize:
+                    break
+
+    class ReplayingStubAsyncConnection:
+        """Replaying stub of AsyncConnection."""
+
+        def __init__(
+            self,
+            *,
+            row_factory: AsyncRowFactory[typing.Any] = tuple_row,
+        ) -> None:
+            self.row_factory = row_factory
+
+        @typing.no_type_check
+        @classmethod
+        async def connect(
+            cls,
+            *a,  # noqa: ANN002, ARG003
+            row_factory: AsyncRowFactory[typing.Any] = tuple_row,
+            **kwa,  # noqa: ANN003, ARG003
+        ) -> AsyncConnection[typing.Any]:
+            return cls(row_factory=row_factory)
+
+        @typing.no_type_check
+        async def close(self, *a, **kwa) -> None:  # noqa: ANN002, ANN003
+            pass
+
+        @typing.no_type_check
+        async def execute(self, *a, **kwa) -> None:  # noqa: ANN002, ANN003
+            curr = self.cursor()
+            return await curr.execute(*a, **kwa)
+
+        @typing.no_type_check
+        def cursor(
+            self,
+            name: str = '',
+            *,
+            row_factory: AsyncRowFactory[typing.Any] | None = None,
+            scrollable: bool | None = None,
+            withhold: bool = False,
+            **kwa,  # noqa: ARG002, ANN003
+        ) -> None:
+            if name:
+                return ReplayingStubAsyncServerCursor(
+                    self,
+                    name,
+                    row_factory=row_factory,
+                    scrollable=scrollable,
+                    withhold=withhold,
+                )
+            return ReplayingStubAsyncCursor(self, row_factory=row_factory)
+
+        @typing.no_type_check
+        async def commit(self, *a, **kwa) -> None:  # noqa: ANN002, ANN003
+            pass
+
+        async def __aenter__(self: typing.Self) -> typing.Self:
+            return self
+
+        async def __aexit__(
+            self: typing.Self,
+            exc_type: type[BaseException] | None,
+            exc_val: BaseException | None,
+            exc_tb: types.TracebackType | None,
+        ) -> bool | None:
+            return None
+
+    @typing.no_type_check
+    class ReplayingStubAsyncConnectionPool:
+        """Replaying stub of AsyncConnectionPool."""
+
+        def __init__(  # noqa: PLR0913
+            self,
+            conninfo: str = '',  # noqa: ARG002
+            *,
+            connection_class: typing.Any = None,  # noqa: ANN401, ARG002
+            kwargs: dict[str, typing.Any] | None = None,
+            min_size: int = 4,  # noqa: ARG002
+            max_size: int | None = None,  # noqa: ARG002
+            open: bool | None = None,  # noqa: A002, ARG002
+            configure: typing.Any = None,  # noqa: ANN401, ARG002
+            check: typing.Any = None,  # noqa: ANN401, ARG002
+            reset: typing.Any = None,  # noqa: ANN401, ARG002
+            name: str | None = None,  # noqa: ARG002
+            timeout: float = 30.0,  # noqa: ARG002
+            max_waiting: int = 0,  # noqa: ARG002
+            max_lifetime: float = 60 * 60.0,  # noqa: ARG002
+            max_idle: float = 10 * 60.0,  # noqa: ARG002
+            reconnect_timeout: float = 5 * 60.0,  # noqa: ARG002
+            reconnect_failed: typing.Any | None = None,  # noqa: ANN401, ARG002
+            num_workers: int = 3,  # noqa: ARG002
+        ) -> None:
+            self._row_factory = (kwargs or {}).get('row_factory', tuple_row)
+
+        @typing.no_type_check
+        async def open(self, *a, **kwa) -> None:  # noqa: A003, ANN002, ANN003
+            pass
+
+        @typing.no_type_check
+        async def close(self, *a, **kwa) -> None:  # noqa: ANN002, ANN003
+            pass
+
+        @typing.no_type_check
+        async def wait(self, *a, **kwa) -> None:  # noqa: ANN002, ANN003
+            pass
+
+        @typing.no_type_check
+        @staticmethod
+        async def check_connection(conn) -> None:  # noqa: ANN001
+            pass
+
+        @typing.no_type_check
+        async def getconn(  # noqa: ANN202
+            self,
+            timeout: float | None = None,  # noqa: ARG002
+        ):
+            return ReplayingStubAsyncConnection(row_factory=self._row_factory)
+
+        @typing.no_type_check
+        @contextlib.asynccontextmanager
+        async def connection(  # noqa: ANN202
+            self,
+            timeout: float | None = None,  # noqa: ARG002
+        ):
+            yield ReplayingStubAsyncConnection(row_factory=self._row_factory)
+
+        async def __aenter__(self: typing.Self) -> typing.Self:
+            return self
+
+        async def __aexit__(
+            self: typing.Self,
+            exc_type: type[BaseException] | None,
+            exc_val: BaseException | None,
+            exc_tb: types.TracebackType | None,
+        ) -> bool | None:
+            return None
+
+    return (
+        ReplayingStubAsyncCursor,
+        ReplayingStubAsyncServerCursor,
+        ReplayingStubAsyncConnection,
+        ReplayingStubAsyncConnectionPool,
+    )
+
+
+def _patch_cursors(cu: type, scu: type) -> None:
+    conn_async = psycopg.connection_async
+    conn_async.AsyncCursor = cu  # type: ignore[attr-defined,assignment]
+    psycopg.cursor_async.AsyncCursor = cu  # type: ignore[misc,assignment]
+    psycopg.AsyncCursor = cu  # type: ignore[misc,assignment]
+    conn_async.AsyncServerCursor = scu  # type: ignore[attr-defined,assignment]
+    psycopg.server_cursor.AsyncServerCursor = scu  # type: ignore[misc,assignment]
+    psycopg.AsyncServerCursor = scu  # type: ignore[misc,assignment]
+
+
+@contextlib.contextmanager
+def use_cassette(
+    vcr_path: pathlib.Path,
+    *,
+    rewrite: bool,
+    responses_dir: pathlib.Path | None,
+    consumed: set[int] | None = None,
+) -> typing.Iterator[None]:
+    """Replace psycopg internals with recording or replaying versions.
+
+    When replaying, positions of the entries used are added to `consumed`.
+    """
+    _orig_cu = psycopg.AsyncCursor
+    _orig_scu = psycopg.AsyncServerCursor
+    _orig_co = None
+    _orig_cp = None
+    conn_async = psycopg.connection_async
+    pool_async = psycopg_pool.pool_async
+
+    if rewrite or not vcr_path.exists():
+        # record queries and results
+        cu = _recording_async_cursor(vcr_path, responses_dir)
+        scu = _recording_async_server_cursor(vcr_path, responses_dir)
+        _patch_cursors(cu, scu)
+        outfile = vcr_path.with_suffix('.tmp')
+        outfile.unlink(missing_ok=True)
+        yield  # record
+        if outfile.exists():
+            outfile.rename(vcr_path)
+            # positions used in the old cassette mean nothing in the new one
+            _cassettes.usage_path(vcr_path).unlink(missing_ok=True)
+    else:
+        # replay queries and results
+        _orig_co = conn_async.AsyncConnection
+        _orig_cp = psycopg_pool.pool_async.AsyncConnectionPool
+        cu, scu, co, cp = _replaying_stub_classes(
+            vcr_path,
+            responses_dir,
+            consumed,
+        )
+        _patch_cursors(cu, scu)
+        conn_async.AsyncConnection = co  # type: ignore[misc,assignment]
+        psycopg.AsyncConnection = co  # type: ignore[misc,assignment]
+        pool_async.AsyncConnection = (  # type: ignore[attr-defined,assignment]
+            co,
+        )
+        pool_async.AsyncConnectionPool = cp  # type: ignore[misc,assignment]
+        psycopg_pool.AsyncConnectionPool = cp  # type: ignore[misc,assignment]
+        yield  # replay
+
+    _patch_cursors(_orig_cu, _orig_scu)
+
+    if _orig_co is not None:
+        conn_async.AsyncConnection = _orig_co  # type: ignore[misc]
+        psycopg.AsyncConnection = _orig_co  # type: ignore[misc]
+        pool_async.AsyncConnection = _orig_co  # type: ignore[attr-defined]
+
+    if _orig_cp is not None:
+        pool_async.AsyncConnectionPool = _orig_cp  # type: ignore[misc]
+        psycopg_pool.AsyncConnectionPool = _orig_cp  # type: ignore[misc]
+
+
+__all__ = ['use_cassette']
@@ -20,6 +20,29 @@ if typing.TYPE_CHECKING:
 pytest_plugins = 'psycopg_vcrlike'  # test my own plugin
 
 
+def pytest_addoption(parser: pytest.Parser) -> None:
+    """Add an option enabling the benchmarks."""
+    parser.addoption(
+        '--bench-json',
+        metavar='PATH',
+        default=None,
+        help='run the benchmarks and write their results to PATH as JSON',
+    )
+
+
+def pytest_collection_modifyitems(
+    config: pytest.Config,
+    items: list[pytest.Item],
+) -> None:
+    """Skip benchmarks unless asked to run them."""
+    if config.getoption('bench_json') is not None:
+        return
+    skip = pytest.mark.skip(reason='benchmarks only run with --bench-json')
+    for item in items:
+        if item.get_closest_marker('benchmark'):
+            item.add_marker(skip)
+
+
 class _Loadable(typing.Protocol):
     def __call__(  # noqa: PLR0913
         self,
@@ -0,0 +1,66 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Tests run by test_preload with a preload window of 2 tests."""
+
+import asyncio
+import pathlib
+import typing
+
+import psycopg
+import pytest
+
+from psycopg_vcrlike import _cassettes, _preload, _server
+
+CASSETTES = pathlib.Path(__file__).parent / 'cassettes' / 'test_inner'
+
+
+def _path(name: str) -> pathlib.Path:
+    return CASSETTES / f'{name}.psycopg.yml'
+
+
+@pytest.mark.vcr()
+def test_first() -> None:
+    """Test the cassette of this test and nothing else is preloaded."""
+    first = _preload.get(_path('test_first'))
+    assert first is not None
+    assert first.result() == _cassettes.load(_path('test_first'))
+    assert _preload.get(_path('test_third')) is None  # outside the window
+
+
+def test_second() -> None:
+    """Test that the used cassette is dropped and the next one preloaded."""
+    assert _preload.get(_path('test_first')) is None
+    assert _preload.get(_path('test_third')) is not None
+
+
+@pytest.mark.vcr()
+def test_third() -> None:
+    """Test the cassette of this test is still there."""
+    third = _preload.get(_path('test_third'))
+    assert third is not None
+    assert third.result()
+
+
+async def _replay() -> list[tuple[typing.Any, ...]]:
+    conn = await psycopg.AsyncConnection.connect()
+    cur = conn.cursor()
+    await cur.execute('SELECT * FROM t ORDER BY i ASC')
+    return await cur.fetchall()
+
+
+@pytest.mark.vcr()
+def test_replay() -> None:
+    """Test replaying from a preloaded cassette, in-process and served."""
+    preloaded = _preload.get(_path('test_replay'))
+    assert preloaded is not None
+    preloaded.result()
+    _path('test_replay').unlink()  # so that only the preloaded one is left
+
+    assert asyncio.run(_replay()) == [(1, 'a'), (2, 'b')]
+    with (
+        _server.serve_cassette(_path('test_replay')) as dsn,
+        psycopg.connect(dsn, autocommit=True) as conn,
+    ):
+        cur = conn.execute('SELECT * FROM t ORDER BY i ASC')
+        assert cur.fetchall() == [(1, 'a'), (2, 'b')]
@@ -0,0 +1,319 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Benchmark recording and replaying throughput and scaling.
+
+Skipped unless ``--bench-json=PATH`` is passed, e.g.:
+
+    pytest tests/test_benchmarks.py --bench-json=bench.json
+"""
+
+import asyncio
+import json
+import pathlib
+import platform
+import time
+import tracemalloc
+import typing
+
+import psycopg
+import pytest
+import ruamel.yaml
+from psycopg.rows import dict_row, tuple_row
+
+from psycopg_vcrlike._vcr import (
+    _recording_async_cursor,
+    _replaying_stub_classes,
+)
+
+pytestmark = pytest.mark.benchmark
+
+REPEAT = 3
+EXECUTES = 50
+
+
+class Bench:
+    """Collects benchmark results."""
+
+    def __init__(self) -> None:
+        """Start with no results."""
+        self.results: list[dict[str, typing.Any]] = []
+
+    def add(
+        self,
+        name: str,
+        params: dict[str, typing.Any],
+        **metrics: float,
+    ) -> None:
+        """Add a result of benchmark `name` ran with `params`."""
+        self.results.append({'name': name, 'params': params, **metrics})
+
+    @staticmethod
+    async def best_of(
+        f: typing.Callable[[], typing.Awaitable[typing.Any]],
+        setup: typing.Callable[[], typing.Awaitable[None]] | None = None,
+        repeat: int = REPEAT,
+    ) -> float:
+        """Return the best wall time of `repeat` runs of `f`, in seconds."""
+        timings = []
+        for _ in range(repeat):
+            if setup is not None:
+                await setup()
+            start = time.perf_counter()
+            await f()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    @staticmethod
+    async def peak_memory(
+        f: typing.Callable[[], typing.Awaitable[typing.Any]],
+    ) -> int:
+        """Return the peak of memory allocated while running `f`, in bytes."""
+        tracemalloc.start()
+        try:
+            await f()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+
+@pytest.fixture(scope='session')
+def bench(request: pytest.FixtureRequest) -> typing.Iterator[Bench]:
+    """Collect results and write them out as JSON at the end."""
+    b = Bench()
+    yield b
+    path = pathlib.Path(request.config.getoption('bench_json'))
+    report = {
+        'python': platform.python_version(),
+        'psycopg': psycopg.__version__,
+        'benchmarks': b.results,
+    }
+    path.write_text(json.dumps(report, indent=2) + '\n')
+
+
+class Synthetic(typing.NamedTuple):
+    """A generated cassette and the queries recorded in it, in order."""
+
+    path: pathlib.Path
+    queries: list[str]
+
+
+@pytest.fixture()
+def cassette(
+    tmp_path: pathlib.Path,
+) -> typing.Callable[[int, int, int], Synthetic]:
+    """Return a generator of cassettes with results of rows x width."""
+
+    def f(entries: int, rows: int, width: int) -> Synthetic:
+        path = tmp_path / f'synthetic_{entries}x{rows}x{width}.psycopg.yml'
+        queries = [
+            f'SELECT * FROM t WHERE id = {i}'  # noqa: S608
+            for i in range(entries)
+        ]
+        description = [
+            {'name': f'c{c}', 'ftype': 23, 'fmod': -1, 'fsize': 4}
+            for c in range(width)
+        ]
+        recording = [
+            {
+                'request': {
+                    'query': q,
+                    'params': None,
+                    'prepare': None,
+                    'binary': None,
+                },
+                'response': [[i * rows + r] * width for r in range(rows)],
+                'description': description,
+                'rowcount': rows,
+                'statusmessage': f'SELECT {rows}',
+            }
+            for i, q in enumerate(queries)
+        ]
+        with path.open('w') as out:
+            ruamel.yaml.YAML(typ='safe').dump(recording, out)
+        return Synthetic(path, queries)
+
+    return f
+
+
+@pytest.mark.parametrize('entries', [10, 100, 1000])
+async def test_cassette_load(
+    bench: Bench,
+    cassette: typing.Callable[[int, int, int], Synthetic],
+    entries: int,
+) -> None:
+    """Benchmark reading and parsing a cassette."""
+    c = cassette(entries, 10, 4)
+    cursor_class, *_ = _replaying_stub_classes(c.path)
+
+    async def load() -> None:
+        await cursor_class()._load_recording()  # noqa: SLF001
+
+    bench.add(
+        'cassette_load',
+        {'entries': entries, 'rows': 10, 'width': 4},
+        seconds=await bench.best_of(load),
+        file_bytes=c.path.stat().st_size,
+        peak_bytes=await bench.peak_memory(load),
+    )
+
+
+@pytest.mark.parametrize('order', ['in_order', 'reversed'])
+@pytest.mark.parametrize('entries', [10, 100, 1000])
+async def test_match_latency(
+    bench: Bench,
+    cassette: typing.Callable[[int, int, int], Synthetic],
+    entries: int,
+    order: str,
+) -> None:
+    """Benchmark matching a query against a loaded cassette."""
+    c = cassette(entries, 1, 1)
+    queries = c.queries if order == 'in_order' else c.queries[::-1]
+    cursor_class, *_ = _replaying_stub_classes(c.path)
+    cur: typing.Any = None
+
+    async def setup() -> None:
+        nonlocal cur
+        cur = cursor_class()
+        await cur._load_recording()  # noqa: SLF001
+
+    async def match_all() -> None:
+        for q in queries:
+            await cur.execute(q)
+
+    seconds = await bench.best_of(match_all, setup)
+    bench.add(
+        'match_latency',
+        {'entries': entries, 'order': order},
+        seconds_per_query=seconds / entries,
+    )
+
+
+@pytest.mark.parametrize('row_factory', [tuple_row, dict_row])
+@pytest.mark.parametrize('method', ['fetchall', 'fetchone'])
+@pytest.mark.parametrize(
+    ('rows', 'width'),
+    [(1000, 2), (20000, 2), (1000, 16)],
+)
+async def test_fetch_throughput(  # noqa: PLR0913
+    bench: Bench,
+    cassette: typing.Callable[[int, int, int], Synthetic],
+    rows: int,
+    width: int,
+    method: str,
+    row_factory: typing.Any,  # noqa: ANN401
+) -> None:
+    """Benchmark fetching replayed rows."""
+    c = cassette(1, rows, width)
+    cursor_class, *_ = _replaying_stub_classes(c.path)
+    cur: typing.Any = None
+
+    async def setup() -> None:
+        nonlocal cur
+        cur = cursor_class(row_factory=row_factory)
+        await cur.execute(c.queries[0])
+
+    async def fetchall() -> None:
+        await cur.fetchall()
+
+    async def fetchone() -> None:
+        while await cur.fetchone() is not None:
+            pass
+
+    f = fetchall if method == 'fetchall' else fetchone
+    seconds = await bench.best_of(f, setup)
+    bench.add(
+        'fetch_throughput',
+        {
+            'rows': rows,
+            'width': width,
+            'method': method,
+            'row_factory': row_factory.__name__,
+        },
+        rows_per_second=rows / seconds,
+    )
+
+
+@pytest.mark.parametrize('cursors', [1, 10, 50])
+async def test_cursor_scaling(
+    bench: Bench,
+    cassette: typing.Callable[[int, int, int], Synthetic],
+    cursors: int,
+) -> None:
+    """Benchmark many cursors replaying from the same cassette."""
+    c = cassette(50, 10, 4)
+    cursor_class, *_ = _replaying_stub_classes(c.path)
+
+    async def replay() -> None:
+        for _ in range(cursors):
+            cur = cursor_class()
+            await cur.execute(c.queries[0])
+            await cur.fetchall()
+
+    bench.add(
+        'cursor_scaling',
+        {'cursors': cursors, 'entries': 50},
+        seconds=await bench.best_of(replay),
+    )
+
+
+@pytest.mark.parametrize('tasks', [1, 10, 50])
+async def test_concurrent_tasks(
+    bench: Bench,
+    cassette: typing.Callable[[int, int, int], Synthetic],
+    tasks: int,
+) -> None:
+    """Benchmark concurrent tasks replaying from the same cassette."""
+    c = cassette(50, 10, 4)
+    cursor_class, *_ = _replaying_stub_classes(c.path)
+
+    async def task() -> None:
+        cur = cursor_class()
+        for q in c.queries[:10]:
+            await cur.execute(q)
+            await cur.fetchall()
+
+    async def replay() -> None:
+        await asyncio.gather(*(task() for _ in range(tasks)))
+
+    bench.add(
+        'concurrent_tasks',
+        {'tasks': tasks, 'queries_per_task': 10, 'entries': 50},
+        seconds=await bench.best_of(replay),
+    )
+
+
+@pytest.mark.parametrize('rows', [1, 1000])
+async def test_recording_overhead(
+    bench: Bench,
+    tmp_path: pathlib.Path,
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+    rows: int,
+) -> None:
+    """Benchmark executing with a recording cursor against a plain one."""
+    query = 'SELECT i, md5(i::text) FROM generate_series(1, %s) i'
+    vcr_path = tmp_path / 'recording.psycopg.yml'
+    recording_class = _recording_async_cursor(vcr_path)
+
+    async def run(cur: psycopg.AsyncCursor[typing.Any]) -> None:
+        for _ in range(EXECUTES):
+            await cur.execute(query, (rows,))
+            await cur.fetchall()
+
+    async def plain() -> None:
+        await run(async_postgresql.cursor())
+
+    async def recording() -> None:
+        await run(recording_class(async_postgresql))
+
+    plain_seconds = await bench.best_of(plain)
+    recording_seconds = await bench.best_of(recording)
+    bench.add(
+        'recording_overhead',
+        {'rows': rows},
+        plain_seconds_per_execute=plain_seconds / EXECUTES,
+        recording_seconds_per_execute=recording_seconds / EXECUTES,
+        overhead_seconds_per_execute=(
+            (recording_seconds - plain_seconds) / EXECUTES
+        ),
+    )
@@ -0,0 +1,180 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Test the cassette maintenance command line interface."""
+
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import typing
+
+import pytest
+import ruamel.yaml
+
+import psycopg_vcrlike
+from psycopg_vcrlike import _cassettes
+from psycopg_vcrlike.__main__ import main
+from psycopg_vcrlike._vcr import _replaying_stub_classes, use_cassette
+
+
+def _entry(
+    query: str,
+    params: list[typing.Any] | None = None,
+    **result: typing.Any,  # noqa: ANN401
+) -> dict[str, typing.Any]:
+    request = {'query': query, 'params': params, 'prepare': None}
+    return {'request': {**request, 'binary': None}, **result}
+
+
+def _recording(table: str) -> _cassettes.Recording:
+    """Return what test_smoke records, for a `table` of its own."""
+    command = {'response': None, 'description': None}
+    inserted = {**command, 'rowcount': 1, 'statusmessage': 'INSERT 0 1'}
+    insert = f'INSERT INTO {table} VALUES (%s, %s)'  # noqa: S608
+    select = f'SELECT * FROM {table} ORDER BY i ASC'  # noqa: S608
+    return [
+        _entry(
+            f'CREATE TABLE {table} (i int, s varchar(50))',
+            **command,
+            rowcount=-1,
+            statusmessage='CREATE TABLE',
+        ),
+        *(_entry(insert, p, **inserted) for p in ([2, 'b'], [1, 'a'])),
+        _entry(
+            select,
+            response=[[1, 'a'], [2, 'b']],
+            description=[
+                {'name': 'i', 'ftype': 23, 'fmod': -1, 'fsize': 4},
+                {'name': 's', 'ftype': 1043, 'fmod': 54, 'fsize': -1},
+            ],
+            rowcount=2,
+            statusmessage='SELECT 2',
+        ),
+    ]
+
+
+@pytest.fixture()
+def cassettes(tmp_path: pathlib.Path) -> list[pathlib.Path]:
+    """Generate a couple of cassettes in a temporary directory."""
+    paths = []
+    for table in 't', 'o':
+        path = tmp_path / f'test_{table}.psycopg.yml'
+        _cassettes.dump(path, _recording(table))
+        paths.append(path)
+    return paths
+
+
+def test_stats(
+    cassettes: list[pathlib.Path],
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    """Test reporting statistics, in parallel."""
+    assert main(['-j', '2', 'stats', '--json', *map(str, cassettes)]) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report['cassettes'][str(cassettes[0])] == {
+        'bytes': cassettes[0].stat().st_size,
+        'entries': 4,
+        'results': 1,
+        'inline_rows': 2,
+        'shared': 0,
+    }
+    assert report['total']['entries'] == 8  # noqa: PLR2004
+
+
+def test_convert_roundtrip(
+    tmp_path: pathlib.Path,
+    cassettes: list[pathlib.Path],
+) -> None:
+    """Test moving responses to a shared store and back."""
+    originals = [c.read_text() for c in cassettes]
+    responses = tmp_path / 'responses'
+    args = ['--responses-dir', str(responses), *map(str, cassettes)]
+
+    main(['convert', '--to', 'shared', *args])
+    assert all(_cassettes.stats(c)['shared'] == 1 for c in cassettes)
+    # both cassettes end up with the same response
+    assert len(_cassettes.stored(responses)) == 1
+
+    main(['convert', '--to', 'inline', *args])
+    assert [c.read_text() for c in cassettes] == originals
+
+
+def test_reindex(
+    tmp_path: pathlib.Path,
+    cassettes: list[pathlib.Path],
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    """Test rebuilding the index and deleting unreferenced responses."""
+    responses = tmp_path / 'responses'
+    args = ['--responses-dir', str(responses)]
+    main(['convert', '--to', 'shared', *args, str(cassettes[0])])
+    (responses / f'{"0" * 64}.yml').write_text('[]\n')
+
+    assert main(['reindex', *args, *map(str, cassettes)]) == 0
+    (digest,) = _cassettes.digests(cassettes[0])
+    index = ruamel.yaml.YAML(typ='safe').load(responses / _cassettes.INDEX)
+    assert index == {digest: [str(cassettes[0])]}
+    assert 'unreferenced' in capsys.readouterr().out
+
+    main(['reindex', '--delete-unreferenced', *args, str(cassettes[0])])
+    assert _cassettes.stored(responses) == [digest]
+
+
+async def test_prune(cassettes: list[pathlib.Path]) -> None:
+    """Test pruning the entries a replay didn't consume."""
+    consumed: set[int] = set()
+    cursor_class, *_ = _replaying_stub_classes(
+        cassettes[0],
+        consumed=consumed,
+    )
+    cur = cursor_class()
+    await cur.execute('SELECT * FROM t ORDER BY i ASC')
+    _cassettes.save_usage(cassettes[0], consumed)
+
+    assert main(['-j', '1', 'prune', *map(str, cassettes)]) == 0
+    (entry,) = _cassettes.load(cassettes[0])
+    assert entry['request']['query'] == 'SELECT * FROM t ORDER BY i ASC'
+    assert not _cassettes.usage_path(cassettes[0]).exists()
+    assert _cassettes.stats(cassettes[1])['entries'] == 4  # noqa: PLR2004
+
+
+def test_rerecording_drops_usage(cassettes: list[pathlib.Path]) -> None:
+    """Test that usage of a cassette is forgotten once it's re-recorded."""
+    _cassettes.save_usage(cassettes[0], {0})
+    with use_cassette(cassettes[0], rewrite=True, responses_dir=None):
+        # as if the other queries were recorded
+        shutil.copy(cassettes[1], cassettes[0].with_suffix('.tmp'))
+    assert not _cassettes.usage_path(cassettes[0]).exists()
+
+
+def test_usage_of_failed_tests(
+    tmp_path: pathlib.Path,
+    cassettes: list[pathlib.Path],
+) -> None:
+    """Test that usage is only saved for tests that have passed."""
+    inner = pathlib.Path(__file__).parent / 'usage_inner.py'
+    shutil.copy(inner, tmp_path / 'test_u.py')
+    (tmp_path / 'cassettes' / 'test_u').mkdir(parents=True)
+    for name in 'test_passing', 'test_failing':
+        shutil.copy(
+            cassettes[0],
+            tmp_path / 'cassettes' / 'test_u' / f'{name}.psycopg.yml',
+        )
+    package_dir = pathlib.Path(psycopg_vcrlike.__file__).parent.parent
+    pythonpath = [str(package_dir), *filter(None, [os.getenv('PYTHONPATH')])]
+    subprocess.run(
+        [  # noqa: S603
+            *(sys.executable, '-m', 'pytest', '-p', 'no:cacheprovider'),
+            *('-p', 'psycopg_vcrlike', '--vcr-psycopg-track-usage'),
+            str(tmp_path / 'test_u.py'),
+        ],
+        cwd=tmp_path,
+        env={**os.environ, 'PYTHONPATH': os.pathsep.join(pythonpath)},
+        capture_output=True,
+        check=False,
+    )
+    used = sorted(p.name for p in tmp_path.glob('cassettes/test_u/*.used'))
+    assert used == ['test_passing.psycopg.used']
@@ -0,0 +1,23 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Test that the plugin stays light for tests not using it."""
+
+import subprocess
+import sys
+
+
+def test_no_heavy_imports() -> None:
+    """Test that loading the plugin doesn't import psycopg and friends."""
+    heavy = ['asyncio', 'psycopg', 'psycopg_pool', 'ruamel.yaml']
+    code = (
+        'import sys, psycopg_vcrlike; '
+        f'print(*[m for m in {heavy!r} if m in sys.modules])'
+    )
+    out = subprocess.run(
+        [sys.executable, '-c', code],  # noqa: S603
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    assert out.split() == []
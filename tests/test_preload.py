@@ -0,0 +1,90 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Test preloading cassettes of upcoming tests in the background."""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import psycopg_vcrlike
+from psycopg_vcrlike import _cassettes, _preload
+from psycopg_vcrlike._vcr import _replaying_stub_classes
+
+QUERY = 'SELECT * FROM t ORDER BY i ASC'
+RECORDING = [
+    {
+        'request': {
+            'query': QUERY,
+            'params': None,
+            'prepare': None,
+            'binary': None,
+        },
+        'response': [[1, 'a'], [2, 'b']],
+        'description': [
+            {'name': 'i', 'ftype': 23, 'fmod': -1, 'fsize': 4},
+            {'name': 's', 'ftype': 1043, 'fmod': 54, 'fsize': -1},
+        ],
+        'rowcount': 2,
+        'statusmessage': 'SELECT 2',
+    },
+]
+
+INNER = pathlib.Path(__file__).parent / 'preload_inner.py'
+
+
+def test_preload(tmp_path: pathlib.Path) -> None:
+    """Test the look-ahead window, dropping and using preloaded cassettes."""
+    shutil.copy(INNER, tmp_path / 'test_inner.py')
+    cassettes = tmp_path / 'cassettes' / 'test_inner'
+    cassettes.mkdir(parents=True)
+    for name in 'test_first', 'test_third', 'test_replay':
+        _cassettes.dump(cassettes / f'{name}.psycopg.yml', RECORDING)
+
+    package_dir = pathlib.Path(psycopg_vcrlike.__file__).parent.parent
+    pythonpath = [str(package_dir), *filter(None, [os.getenv('PYTHONPATH')])]
+    r = subprocess.run(
+        [  # noqa: S603
+            *(sys.executable, '-m', 'pytest', '-p', 'no:cacheprovider'),
+            *('-p', 'psycopg_vcrlike', '--vcr-psycopg-preload'),
+            *('--vcr-psycopg-preload-window', '2', str(tmp_path)),
+        ],
+        cwd=tmp_path,
+        env={**os.environ, 'PYTHONPATH': os.pathsep.join(pythonpath)},
+        capture_output=True,
+        check=False,
+        text=True,
+    )
+    assert r.returncode == 0, r.stdout
+    assert '4 passed' in r.stdout
+
+
+async def test_cancelled_while_preloading(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test cancelling an execute waiting for its cassette to preload."""
+    path = tmp_path / 'test_cancelled.psycopg.yml'
+    _cassettes.dump(path, RECORDING)
+    preloaded: concurrent.futures.Future[_cassettes.Recording]
+    preloaded = concurrent.futures.Future()
+    monkeypatch.setitem(_preload._preloaded, path, preloaded)  # noqa: SLF001
+    cursor_class, *_ = _replaying_stub_classes(path)
+
+    task = asyncio.create_task(cursor_class().execute(QUERY))
+    await asyncio.sleep(0)
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    assert not preloaded.cancelled()  # shared with the later cursors
+
+    preloaded.set_result(_cassettes.load(path))
+    cur = await cursor_class().execute(QUERY)
+    assert await cur.fetchall() == [(1, 'a'), (2, 'b')]
@@ -0,0 +1,130 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Test sharing identical responses between cassettes."""
+
+import pathlib
+import typing
+
+import psycopg
+import pytest
+import ruamel.yaml
+
+from psycopg_vcrlike import _aio_fileutils_builtin as aiofileutils
+from psycopg_vcrlike import _cassettes, _response_store
+from psycopg_vcrlike._vcr import _replaying_stub_classes
+
+RESPONSES = pathlib.Path(__file__).parent / 'cassettes' / 'responses'
+
+
+@pytest.fixture()
+def vcr_psycopg_responses_dir() -> str:
+    """Use a shared response store for this module."""
+    return str(RESPONSES)
+
+
+async def _lookup(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> psycopg.AsyncCursor[typing.Any]:
+    cur = async_postgresql.cursor()
+    await cur.execute("SELECT * FROM (VALUES (1, 'a'), (2, 'b')) AS v (i, s)")
+    assert await cur.fetchall() == [(1, 'a'), (2, 'b')]
+    await cur.close()
+    return cur
+
+
+@pytest.mark.vcr()
+async def test_shared_first(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> None:
+    """Test a lookup with its response in the shared store."""
+    cur = await _lookup(async_postgresql)
+    _assert_shared(cur, 'test_shared_first')
+
+
+@pytest.mark.vcr()
+async def test_shared_second(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> None:
+    """Test the same lookup referring to the same stored response."""
+    cur = await _lookup(async_postgresql)
+    _assert_shared(cur, 'test_shared_second')
+
+
+@pytest.mark.vcr()
+async def test_shared_batches(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> None:
+    """Test that batches of a server-side cursor aren't kept once fetched."""
+    async with async_postgresql.cursor('batches') as cur:
+        cur.itersize = 100
+        await cur.execute('SELECT i FROM generate_series(1, 250) AS s (i)')
+        assert [row async for row in cur] == [(i,) for i in range(1, 251)]
+    recording = cur.__class__.__name__ == 'RecordingAsyncServerCursor'
+    _, *batches = _load('test_shared_batches', recording=recording)
+    assert len(batches) == 3  # noqa: PLR2004
+    loaded = _response_store._loaded  # noqa: SLF001
+    for entry in batches:
+        assert 'response' not in entry
+        assert entry['response_sha256'] not in loaded
+
+
+async def test_parsed_once(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test that cassettes sharing a response share one parsed copy."""
+    responses = tmp_path / 'responses'
+    digest = await _response_store.save(responses, [[1, 'a'], [2, 'b']])
+    monkeypatch.setattr(_response_store, '_loaded', {})
+    reads: list[pathlib.Path] = []
+    read_file = aiofileutils.read_file
+
+    async def counting_read_file(
+        path: pathlib.Path,
+        mode: 'aiofileutils.ModeRead',
+    ) -> str:
+        reads.append(path)
+        return await read_file(path, mode)
+
+    monkeypatch.setattr(aiofileutils, 'read_file', counting_read_file)
+
+    cursors = []
+    for name in 'first', 'second':
+        path = tmp_path / f'{name}.psycopg.yml'
+        request = {'query': 'SELECT 1', 'params': None}
+        entry = {'request': {**request, 'prepare': None, 'binary': None}}
+        _cassettes.dump(path, [{**entry, 'response_sha256': digest}])
+        cursor_class, *_ = _replaying_stub_classes(path, responses)
+        cur = cursor_class()
+        await cur.execute('SELECT 1')
+        assert await cur.fetchall() == [(1, 'a'), (2, 'b')]
+        cursors.append(cur)
+
+    rows = _response_store._loaded[digest]  # noqa: SLF001
+    assert all(cur._rows is rows for cur in cursors)  # noqa: SLF001
+    assert reads.count(_response_store.path(responses, digest)) == 1
+
+
+def _load(
+    test_name: str,
+    *,
+    recording: bool,
+) -> list[dict[str, typing.Any]]:
+    p = pathlib.Path(
+        'tests',
+        'cassettes',
+        'test_response_store',
+        f'{test_name}.psycopg.{"tmp" if recording else "yml"}',
+    )
+    return list(ruamel.yaml.YAML(typ='safe').load(p.read_text()))
+
+
+def _assert_shared(
+    cur: psycopg.AsyncCursor[typing.Any],
+    test_name: str,
+) -> None:
+    recording = cur.__class__.__name__ == 'RecordingAsyncCursor'
+    (entry,) = _load(test_name, recording=recording)
+    assert 'response' not in entry
+    assert (RESPONSES / f'{entry["response_sha256"]}.yml').exists()
@@ -0,0 +1,90 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Test result metadata and row factories recording/replaying."""
+
+import dataclasses
+import pathlib
+import typing
+
+import psycopg
+import pytest
+from psycopg.rows import class_row, dict_row, namedtuple_row
+
+from psycopg_vcrlike._vcr import _replaying_stub_classes
+
+INT4_OID = 23
+# static, unlike tests/cassettes, which get removed and re-recorded
+BASELINE = (
+    pathlib.Path(__file__).parent / 'data' / 'baseline_fetchall.psycopg.yml'
+)
+
+
+@dataclasses.dataclass
+class _R:
+    i: int
+    s: str
+
+
+@pytest.mark.vcr()
+async def test_metadata(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> None:
+    """Test .description, .rowcount and .statusmessage."""
+    cur = async_postgresql.cursor()
+    await cur.execute('CREATE TABLE m (i int, s varchar(50))')
+    assert cur.description is None
+    await cur.execute('INSERT INTO m VALUES (1, %s), (2, %s)', ('a', 'b'))
+    assert cur.rowcount == 2  # noqa: PLR2004
+    assert cur.statusmessage == 'INSERT 0 2'
+    await cur.execute('SELECT * FROM m ORDER BY i ASC')
+    assert cur.description is not None
+    assert [c.name for c in cur.description] == ['i', 's']
+    assert cur.description[0].type_code == INT4_OID
+    assert cur.rowcount == 2  # noqa: PLR2004
+    assert cur.statusmessage == 'SELECT 2'
+    assert await cur.fetchall() == [(1, 'a'), (2, 'b')]
+    await async_postgresql.commit()
+    await cur.close()
+
+
+@pytest.mark.vcr()
+async def test_row_factories(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> None:
+    """Test dict_row, namedtuple_row and class_row."""
+    cur = async_postgresql.cursor(row_factory=dict_row)
+    await cur.execute('CREATE TABLE f (i int, s varchar(50))')
+    await cur.execute('INSERT INTO f VALUES (1, %s), (2, %s)', ('a', 'b'))
+    await cur.execute('SELECT * FROM f ORDER BY i ASC')
+    assert await cur.fetchone() == {'i': 1, 's': 'a'}
+    assert await cur.fetchall() == [{'i': 2, 's': 'b'}]
+    await cur.close()
+
+    ncur = async_postgresql.cursor(row_factory=namedtuple_row)
+    await ncur.execute('SELECT * FROM f ORDER BY i ASC')
+    rows = await ncur.fetchall()
+    assert rows[0]._fields == ('i', 's')
+    assert [tuple(r) for r in rows] == [(1, 'a'), (2, 'b')]
+    await ncur.close()
+
+    ccur = async_postgresql.cursor(row_factory=class_row(_R))
+    await ccur.execute('SELECT * FROM f ORDER BY i ASC')
+    assert await ccur.fetchall() == [_R(1, 'a'), _R(2, 'b')]
+    await ccur.close()
+
+    await async_postgresql.commit()
+
+
+async def test_without_metadata() -> None:
+    """Test replaying a cassette recorded before metadata was."""
+    cursor_class, *_ = _replaying_stub_classes(BASELINE)
+    cur = cursor_class()
+    await cur.execute('SELECT * FROM t ORDER BY i ASC')
+    assert await cur.fetchone() == (1, 'a')
+    assert cur.rowcount == 2  # noqa: PLR2004
+    assert await cur.fetchall() == [(2, 'b')]
+
+    dcur = cursor_class(row_factory=dict_row)
+    with pytest.raises(RuntimeError, match='without column names'):
+        await dcur.execute('SELECT * FROM t ORDER BY i ASC')
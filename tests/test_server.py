@@ -0,0 +1,117 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Test replaying cassettes to other processes over the wire protocol."""
+
+import pathlib
+import subprocess
+import sys
+import typing
+
+import psycopg
+import pytest
+
+from psycopg_vcrlike import _server
+
+QUERY = 'SELECT i, i::text AS s FROM generate_series(1, %s) AS g (i)'
+EXPECTED = [(1, '1'), (2, '2'), (3, '3')]
+REPEATED = 'SELECT %s::int AS n'
+REPEATS = 8  # psycopg prepares queries after 5 executions
+# static, unlike tests/cassettes, which get removed and re-recorded
+_BASELINE = (
+    pathlib.Path(__file__).parent / 'data' / 'baseline_fetchall.psycopg.yml'
+)
+
+CLIENT = (
+    'import sys, psycopg\n'
+    'with psycopg.connect(sys.argv[1]) as conn:\n'
+    f'    print(conn.execute({QUERY!r}, (3,)).fetchall())\n'
+    '    print(conn.execute("SELECT \'served\' AS s").fetchone())\n'
+)
+
+
+@pytest.mark.vcr()
+@pytest.mark.default_cassette('test_served')
+async def test_record(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> None:
+    """Record in-process what test_served replays to other processes."""
+    cur = await async_postgresql.execute(QUERY, (3,))
+    assert await cur.fetchall() == EXPECTED
+    cur = await async_postgresql.execute("SELECT 'served' AS s")
+    assert await cur.fetchone() == ('served',)
+    for _ in range(REPEATS):
+        cur = await async_postgresql.execute(REPEATED, (1,))
+        assert await cur.fetchone() == (1,)
+    await async_postgresql.commit()
+
+
+@pytest.mark.vcr()
+@pytest.mark.default_cassette('test_served')
+def test_served(vcr_psycopg_dsn: str) -> None:
+    """Test several subprocesses replaying one cassette at once."""
+    clients = [
+        subprocess.Popen(
+            [sys.executable, '-c', CLIENT, vcr_psycopg_dsn],  # noqa: S603
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for _ in range(4)
+    ]
+    for client in clients:
+        out, _ = client.communicate(timeout=60)
+        assert client.returncode == 0
+        assert out == f"{EXPECTED}\n('served',)\n"
+
+
+@pytest.mark.vcr()
+@pytest.mark.default_cassette('test_served')
+def test_served_errors(vcr_psycopg_dsn: str) -> None:
+    """Test what's not in the cassette and what's replayed only once."""
+    with psycopg.connect(vcr_psycopg_dsn, autocommit=True) as conn:
+        assert conn.execute(QUERY, (3,)).fetchall() == EXPECTED
+        with pytest.raises(psycopg.errors.InternalError_, match='no match'):
+            conn.execute(QUERY, (3,))
+        with pytest.raises(psycopg.errors.InternalError_, match='no match'):
+            conn.execute('SELECT 1')
+        with conn.transaction():
+            cur = conn.execute("SELECT 'served' AS s")
+            assert cur.description is not None
+            assert cur.description[0].name == 's'
+            assert cur.fetchone() == ('served',)
+
+
+@pytest.mark.vcr()
+@pytest.mark.default_cassette('test_served')
+def test_served_prepared(vcr_psycopg_dsn: str) -> None:
+    """Test psycopg preparing a query and cleaning up on rollback."""
+    with psycopg.connect(vcr_psycopg_dsn) as conn:
+        for _ in range(REPEATS):
+            assert conn.execute(REPEATED, (1,)).fetchone() == (1,)
+        with pytest.raises(psycopg.errors.InternalError_, match='no match'):
+            conn.execute('SELECT 1')
+        conn.rollback()  # deallocates the prepared statements
+        with conn.transaction():
+            assert conn.execute("SELECT 'served' AS s").fetchone()
+
+
+def test_served_without_metadata() -> None:
+    """Test serving a cassette recorded before metadata was."""
+    with (
+        _server.serve_cassette(_BASELINE) as dsn,
+        psycopg.connect(dsn, autocommit=True) as conn,
+    ):
+        cur = conn.execute('SELECT * FROM t ORDER BY i ASC')
+        # column types weren't recorded either, so it's all text
+        assert cur.fetchall() == [('1', 'a'), ('2', 'b')]
+        assert cur.statusmessage == 'SELECT 2'
+
+
+def test_stop_with_clients_connected(caplog: pytest.LogCaptureFixture) -> None:
+    """Test stopping the server while clients are still connected."""
+    with _server.serve_cassette(_BASELINE) as dsn:
+        conns = [psycopg.connect(dsn) for _ in range(3)]
+        conns[0].execute('SELECT * FROM t ORDER BY i ASC')
+    for conn in conns:
+        conn.close()
+    assert not [r for r in caplog.records if r.name == 'asyncio']
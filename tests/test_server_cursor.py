@@ -0,0 +1,53 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Test server-side (named) cursors recording/replaying."""
+
+import typing
+
+import psycopg
+import pytest
+from psycopg.rows import dict_row
+
+QUERY = 'SELECT i, i * 2 AS d FROM generate_series(1, %s) AS s (i)'
+
+
+@pytest.mark.vcr()
+async def test_iteration(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> None:
+    """Test iterating over a server-side cursor in itersize batches."""
+    async with async_postgresql.cursor('it') as cur:
+        cur.itersize = 100
+        await cur.execute(QUERY, (250,))
+        assert cur.description is not None
+        assert [c.name for c in cur.description] == ['i', 'd']
+        rows = [row async for row in cur]
+    assert rows == [(i, i * 2) for i in range(1, 251)]
+
+
+@pytest.mark.vcr()
+async def test_fetches(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> None:
+    """Test .fetchone, .fetchmany and .fetchall with a row factory."""
+    cur = async_postgresql.cursor('f', row_factory=dict_row)
+    await cur.execute(QUERY, (10,))
+    assert await cur.fetchone() == {'i': 1, 'd': 2}
+    assert await cur.fetchmany(3) == [{'i': i, 'd': i * 2} for i in (2, 3, 4)]
+    assert await cur.fetchall() == [{'i': i, 'd': i * 2} for i in range(5, 11)]
+    assert await cur.fetchone() is None
+    await cur.close()
+
+
+@pytest.mark.vcr()
+async def test_reused_name(
+    async_postgresql: psycopg.AsyncConnection[tuple[typing.Any, ...]],
+) -> None:
+    """Test paging with cursors declared under the same name."""
+    for n in 1, 2:
+        async with async_postgresql.cursor('page') as cur:
+            await cur.execute(QUERY, (n,))
+            assert await cur.fetchall() == [
+                (i, i * 2) for i in range(1, n + 1)
+            ]
@@ -0,0 +1,17 @@
+# SPDX-FileCopyrightText: 2023 Alexander Sosedkin <monk@unboiled.info>
+# SPDX-License-Identifier: GPL-3.0
+
+"""Tests run by test_cli with --vcr-psycopg-track-usage."""
+
+import pytest
+
+
+@pytest.mark.vcr()
+def test_passing() -> None:
+    """Test nothing, successfully."""
+
+
+@pytest.mark.vcr()
+def test_failing() -> None:
+    """Fail before using the cassette."""
+    pytest.fail('on purpose')